@@ -1,4 +1,8 @@
 # import libraries
+import os
+import json
+import urllib.request
+from functools import lru_cache
 import polars as pl
 import us
 from dash import Dash, dcc, html, Input, Output, _dash_renderer, no_update, ctx
@@ -6,31 +10,32 @@ from dash._callback import PreventUpdate
 import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
 import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
 # set react version for dmc components
 _dash_renderer._set_react_version("18.2.0")
 # set plotly theme
-pio.templates.default = "plotly_white"
+# only keep the layout part of the theme (the per trace defaults are serialized with every figure)
+pio.templates["plotly_white_layout"] = go.layout.Template(layout = pio.templates["plotly_white"].layout)
+pio.templates.default = "plotly_white_layout"
 
-def find_state_code(state_name):
-    # map state name to state code
-    state = us.states.lookup(state_name)
-    # check that state is not None and that state is not a US territory
-    if state is not None and not state.is_territory:
-        return state.abbr
-    return ""
+# map state name to state code (excluding US territories)
+STATE_MAP = {state.name: state.abbr for state in us.STATES_AND_TERRITORIES if not state.is_territory}
+# map state code to state fips code (the first two digits of county fips codes)
+STATE_FIPS_MAP = {state.abbr: state.fips for state in us.STATES_AND_TERRITORIES if not state.is_territory}
 
 def clean_data():
     # read in the csv data
     df = pl.read_csv("rural-investments.csv", ignore_errors = True)
 
     # convert "County FIPS" to string
-    # convert "Investment Dollars" to float
+    # convert "Investment Dollars" to float and "Number of Investments" to int (32 bit is precise enough)
     # create "State Code" column
     df = df.with_columns([
         pl.col("County FIPS").str.replace("'", "").str.zfill(5),
-        pl.col("Investment Dollars").str.replace_all(",", "").cast(pl.Float64),
-        pl.col("State Name").map_elements(find_state_code, return_dtype = pl.Utf8).alias("State Code")
+        pl.col("Investment Dollars").str.replace_all(",", "").cast(pl.Float32),
+        pl.col("Number of Investments").cast(pl.Int32),
+        pl.col("State Name").replace_strict(STATE_MAP, default = "").alias("State Code")
     ])
 
     # remove data for US territories (which do not show up in the US maps)
@@ -38,13 +43,48 @@ def clean_data():
 
     return df
 
+def load_data(csv_path = "rural-investments.csv", parquet_path = "rural-investments.parquet"):
+    # read the cleaned data from the parquet cache if it is newer than the csv
+    if os.path.exists(parquet_path) and os.path.getmtime(csv_path) <= os.path.getmtime(parquet_path):
+        return pl.scan_parquet(parquet_path).collect()
+    # otherwise clean the csv data and write it to the parquet cache
+    df = clean_data()
+    df.write_parquet(parquet_path, compression = "zstd")
+    return df
+
+def load_counties_geojson(url = "https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json", path = "geojson-counties-fips.json"):
+    # download the county geojson once and read it from disk afterwards
+    if not os.path.exists(path):
+        with urllib.request.urlopen(url) as response, open(path, "wb") as f:
+            f.write(response.read())
+    with open(path) as f:
+        return json.load(f)
+
+def split_counties_geojson(counties_geojson):
+    # group county features by state fips code
+    features = {}
+    for feature in counties_geojson["features"]:
+        features.setdefault(feature["id"][:2], []).append(feature)
+    # create a geojson with only the counties in each state
+    return {
+        state: {"type": "FeatureCollection", "features": features.get(fips, [])}
+        for state, fips in STATE_FIPS_MAP.items()
+    }
+
 def group_and_calc_data(df, group_by):
-    # create sum, count, and average columns
-    return df.group_by(group_by).agg([
+    # create sum and count columns for all investments and socially vulnerable investments
+    # then create average and proportion socially vulnerable columns
+    svi = pl.col("Svi Status") == "Socially Vulnerable"
+    return df.group_by(group_by, maintain_order = False).agg([
         pl.col("Investment Dollars").sum().alias("Sum Investment Dollars"), 
         pl.col("Number of Investments").sum(),
-        (pl.col("Investment Dollars").sum() / pl.col("Number of Investments").sum()).alias("Average Investment Dollars"),
-    ])
+        pl.when(svi).then(pl.col("Investment Dollars")).otherwise(0).sum().alias("Sum Investment Dollars SVI"),
+        pl.when(svi).then(pl.col("Number of Investments")).otherwise(0).sum().alias("Number of Investments SVI")
+    ]).with_columns([
+        (pl.col("Sum Investment Dollars") / pl.col("Number of Investments")).alias("Average Investment Dollars"),
+        (pl.col("Sum Investment Dollars SVI") / pl.col("Sum Investment Dollars")).fill_null(0).alias("Prop Investment Dollars SVI"),
+        (pl.col("Number of Investments SVI") / pl.col("Number of Investments")).fill_null(0).alias("Prop Number of Investments SVI")
+    ]).drop(["Sum Investment Dollars SVI", "Number of Investments SVI"])
 
 def create_plot_data(df, group_by, state = None):
     # filter for state if state is not None
@@ -52,17 +92,8 @@ def create_plot_data(df, group_by, state = None):
         data = df.filter(pl.col("State Code") == state)
     else:
         data = df
-    # create sum, count, and average columns
-    # add proportion socially vulnerable columns for sum and count
-    data = group_and_calc_data(data, group_by).join(
-        other = group_and_calc_data(data.filter(pl.col("Svi Status") == "Socially Vulnerable"), group_by),
-        on = group_by,
-        how = "left"
-    ).with_columns([
-        (pl.col("Sum Investment Dollars_right") / pl.col("Sum Investment Dollars")).fill_null(0).alias("Prop Investment Dollars SVI"),
-        (pl.col("Number of Investments_right") / pl.col("Number of Investments")).fill_null(0).alias("Prop Number of Investments SVI"),
-    ]).drop(["Sum Investment Dollars_right", "Number of Investments_right", "Average Investment Dollars_right"])
-    return data
+    # create sum, count, average, and proportion socially vulnerable columns in a single lazy query
+    return group_and_calc_data(data, group_by).collect(engine = "streaming")
 
 def create_map(plot_data, metric, state = None):
     # create plotly express choropleth map at the state or county level
@@ -77,7 +108,7 @@ def create_map(plot_data, metric, state = None):
     else:
         # county level
         params = dict(
-            geojson = "https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json", 
+            geojson = state_counties_geojson[state], 
             locations = "County FIPS",
             hover_data = ["County"],
             title = f"{metric} by County (State = {state})"
@@ -119,6 +150,26 @@ def create_bar_chart(plot_data, metric, variable, state = None):
     fig.update_traces(marker_color = "Black", marker_line_color = "Black")
     return fig
 
+# cache figures (as dicts) for repeated metric, variable, and state selections
+@lru_cache(maxsize = 128)
+def create_state_map(metric):
+    plot_data = create_plot_data(df_lazy, group_by = ("State Name", "State Code"))
+    return create_map(plot_data, metric = metric).to_dict()
+
+@lru_cache(maxsize = 128)
+def create_county_map(metric, state):
+    return create_map(county_plot_data[state], metric = metric, state = state).to_dict()
+
+@lru_cache(maxsize = 128)
+def create_overall_bar_chart(metric, variable):
+    plot_data = create_plot_data(df_lazy, group_by = variable)
+    return create_bar_chart(plot_data, metric = metric, variable = variable).to_dict()
+
+@lru_cache(maxsize = 128)
+def create_state_bar_chart(metric, variable, state):
+    plot_data = create_plot_data(df_lazy, group_by = variable, state = state)
+    return create_bar_chart(plot_data, metric = metric, variable = variable, state = state).to_dict()
+
 # create selection row
 def create_selection_row(card_header, options, default_value, id):
     return dbc.Row([
@@ -158,7 +209,14 @@ def create_plots_row(left_id, right_id):
     ])
 
 # create data
-df = clean_data()
+df = load_data()
+df_lazy = df.lazy()
+state_counties_geojson = split_counties_geojson(load_counties_geojson())
+# precompute county level plot data for each state (one group by, then split by state code)
+county_plot_data = {
+    key[0]: data for key, data in create_plot_data(df_lazy, group_by = ("State Name", "State Code", "County", "County FIPS")). \
+        partition_by("State Code", as_dict = True).items()
+}
 
 # create dash app
 app = Dash(external_stylesheets = [dbc.themes.CERULEAN])
@@ -211,10 +269,8 @@ def update_overall_plots(metric, variable):
     if ctx.triggered_id == "variable":
         state_map = no_update
     else:
-        state_map_plot_data = create_plot_data(df, group_by = ["State Name", "State Code"])
-        state_map = create_map(state_map_plot_data, metric = metric)
-    overall_bar_chart_data = create_plot_data(df, group_by = variable)
-    overall_bar_chart = create_bar_chart(overall_bar_chart_data, metric = metric, variable = variable)
+        state_map = create_state_map(metric)
+    overall_bar_chart = create_overall_bar_chart(metric, variable)
     return state_map, overall_bar_chart
 
 @app.callback(
@@ -245,10 +301,8 @@ def update_state_plots(click_data, metric, variable):
         if ctx.triggered_id == "variable":
             county_map = no_update
         else:
-            county_map_plot_data = create_plot_data(df, group_by = ["State Name", "State Code", "County", "County FIPS"], state = state)
-            county_map = create_map(county_map_plot_data, metric = metric, state = state)
-        state_map_plot_data = create_plot_data(df, group_by = variable, state = state)
-        state_bar_chart = create_bar_chart(state_map_plot_data, metric = metric, variable = variable, state = state)
+            county_map = create_county_map(metric, state)
+        state_bar_chart = create_state_bar_chart(metric, variable, state)
         col_info = dict(left_col_width = 6, right_col_width = 6, right_col_style = {"display": "block"})
         return {
             "county_map": {
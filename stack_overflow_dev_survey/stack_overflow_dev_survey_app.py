@@ -1,16 +1,21 @@
 # import libraries
+import os
+from functools import lru_cache
 import polars as pl
 import us
-from dash import Dash, dcc, html, Input, Output, _dash_renderer, no_update, ctx
+from dash import Dash, dcc, html, Input, Output, MATCH, ALL, _dash_renderer, no_update, ctx
 from dash._callback import PreventUpdate
 import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
 import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
 # set react version for dmc components
 _dash_renderer._set_react_version("18.2.0")
 # set plotly theme
-pio.templates.default = "plotly_dark"
+# only keep the layout part of the theme (the per trace defaults are serialized with every figure)
+pio.templates["plotly_dark_layout"] = go.layout.Template(layout = pio.templates["plotly_dark"].layout)
+pio.templates.default = "plotly_dark_layout"
 
 groups_info = {
     "EdLevel": {
@@ -43,31 +48,40 @@ def clean_data(groups_info):
     # this file is not on github due to size constraints
     df = pl.read_csv("survey_results_public.csv")
     # shorten/summarize values in ed level, main branch, and purchase influence columns
-    for k, v in groups_info.items():
-        if type(v) == dict:
-            df = df.with_columns(pl.col(k).replace(v))
-    # convert converted yearly compensation, years code, and years code pro columns to float
+    df = df.with_columns([pl.col(k).replace(v) for k, v in groups_info.items() if type(v) == dict])
+    # convert converted yearly compensation, years code, and years code pro columns to float (32 bit is precise enough)
+    # values that cannot be parsed (NA) become null
     df = df.with_columns([
-        pl.col("ConvertedCompYearly").replace({"NA": None}).cast(pl.Float64).alias("ConvertedCompYearly"),
-        pl.col("YearsCode").replace({"NA": None, "Less than 1 year": 0.5, "More than 50 years": 51}).cast(pl.Float64).alias("YearsCode"),
-        pl.col("YearsCodePro").replace({"NA": None, "Less than 1 year": 0.5, "More than 50 years": 51}).cast(pl.Float64).alias("YearsCodePro")
+        pl.col("ConvertedCompYearly").cast(pl.Float32, strict = False).alias("ConvertedCompYearly"),
+        pl.col("YearsCode").replace({"Less than 1 year": "0.5", "More than 50 years": "51"}).str.strip_chars().cast(pl.Float32, strict = False).alias("YearsCode"),
+        pl.col("YearsCodePro").replace({"Less than 1 year": "0.5", "More than 50 years": "51"}).str.strip_chars().cast(pl.Float32, strict = False).alias("YearsCodePro")
     ])
     # create bucket columns for years code and years code pro columns
     # these are not required columns (so include NA column)
-    for col in ["YearsCode", "YearsCodePro"]:
-        df = df.with_columns(
-            pl.when(pl.col(col).is_null()).then(pl.lit("NA")). \
-            when(pl.col(col) < 10).then(pl.lit("0-9 Years")). \
-            when(pl.col(col) < 20).then(pl.lit("10-19 Years")). \
-            when(pl.col(col) < 30).then(pl.lit("20-29 Years")). \
-            when(pl.col(col) < 40).then(pl.lit("30-39 Years")). \
-            when(pl.col(col) < 50).then(pl.lit("40-49 Years")). \
-            otherwise(pl.lit("50+ Years")).alias(col + "Buckets")
-        )
+    labels = ["0-9 Years", "10-19 Years", "20-29 Years", "30-39 Years", "40-49 Years", "50+ Years"]
+    df = df.with_columns([
+        pl.col(col).cut(breaks = [10, 20, 30, 40, 50], labels = labels, left_closed = True).cast(pl.Utf8).fill_null(pl.lit("NA")).alias(col + "Buckets")
+        for col in ["YearsCode", "YearsCodePro"]
+    ])
+    return df
+
+def load_data(groups_info, csv_path = "survey_results_public.csv", parquet_path = "survey_results_public.parquet"):
+    # read the cleaned data from the parquet cache if it is newer than the csv
+    if os.path.exists(parquet_path) and os.path.getmtime(csv_path) <= os.path.getmtime(parquet_path):
+        return pl.scan_parquet(parquet_path).collect()
+    # otherwise clean the csv data and write it to the parquet cache
+    df = clean_data(groups_info)
+    df.write_parquet(parquet_path, compression = "zstd")
     return df
 
 def find_tech_categories(df):
-    return sorted(list(set([col.replace("HaveWorkedWith", "").replace("WantToWorkWith", "") for col in df.columns if "HaveWorkedWith" in col or "WantToWorkWith" in col])))
+    # strip the have or want suffix from each column name (dict keys remove duplicates)
+    tech_categories = {}
+    for col in df.collect_schema().names():
+        for suffix in ("HaveWorkedWith", "WantToWorkWith"):
+            if col.endswith(suffix):
+                tech_categories[col.removesuffix(suffix)] = None
+    return sorted(tech_categories)
 
 def find_have_want_columns(tech_category):
     return f"{tech_category}HaveWorkedWith", f"{tech_category}WantToWorkWith"
@@ -80,94 +94,107 @@ def explode_column(df, column, groups = []):
     return df.with_columns(pl.col(column).str.split(";")).explode(column). \
         select([pl.col(col) for col in ["ResponseId", column] + groups])
 
-def create_have_want_df(df, have_column, want_column, groups = []):
+def create_have_want_df(df, tech_category, groups = []):
+    have_column, want_column = find_have_want_columns(tech_category)
     # expand have and want columns (create a row for each tech listed in the columns)
-    have_df, want_df = explode_column(df, have_column, groups = groups), explode_column(df, want_column, groups = groups)
-    # full join have and want dataframes 
-    have_want_df = have_df.join(other = want_df, left_on = ["ResponseId", have_column] + groups, right_on = ["ResponseId", want_column] + groups, how = "full")
-    # coalesce right and left columns to remove duplicate information and missing values
-    for col in [col.replace("_right", "") for col in have_want_df.columns if "_right" in col]:
-        have_want_df = have_want_df.with_columns(pl.coalesce([col, col + "_right"]).alias(col)).drop(col + "_right")
-    return have_want_df
+    # flag whether each row comes from the have or the want column
+    have_df = explode_column(df, have_column, groups = groups).rename({have_column: tech_category}). \
+        with_columns(has = pl.lit(True), wants = pl.lit(False))
+    want_df = explode_column(df, want_column, groups = groups).rename({want_column: tech_category}). \
+        with_columns(has = pl.lit(False), wants = pl.lit(True))
+    # combine have and want dataframes (one row per respondent and tech)
+    # has and wants indicate whether the respondent has worked with and/or wants to work with the tech
+    return pl.concat([have_df, want_df]).group_by(["ResponseId", tech_category] + groups, maintain_order = False). \
+        agg(pl.col("has").any(), pl.col("wants").any())
 
-def create_have_want_count_df(tech_category, column, have_want_df, groups = [], clean = False):
-    have_want_count_df = have_want_df.filter(~pl.col(column).is_null()).group_by([column] + groups).len()
+def create_have_want_count_df(tech_category, indicator, have_want_df, groups = [], clean = False):
+    have_want_count_df = have_want_df.filter(pl.col(indicator)).group_by([tech_category] + groups, maintain_order = False).len()
     if clean:
-        return have_want_count_df.rename({column: tech_category}).sort("len", descending = True)
+        return have_want_count_df.sort("len", descending = True)
     return have_want_count_df
 
-def create_have_want_prop_df(tech_category, column, have_want_df, groups = [], clean = False, exclusion_prop = None):
-    have_want_count_df = create_have_want_count_df(tech_category, column, have_want_df, groups = groups, clean = False)
+def create_have_want_prop_df(tech_category, indicator, have_want_df, n_respondents, groups = [], clean = False, exclusion_prop = None):
+    have_want_count_df = create_have_want_count_df(tech_category, indicator, have_want_df, groups = groups, clean = False)
     # find proportion of total respondents (to the relevant have and want questions) who have or want the tech
-    have_want_prop_df = have_want_count_df.with_columns((pl.col("len") / have_want_df["ResponseId"].unique().len()).alias("prop"))
+    have_want_prop_df = have_want_count_df.with_columns((pl.col("len") / n_respondents).alias("prop"))
     if exclusion_prop is not None:
         have_want_prop_df = have_want_prop_df.filter(pl.col("prop") >= exclusion_prop)
     if clean:
-        return have_want_prop_df.rename({column: tech_category}).drop("len").sort("prop", descending = True)
+        return have_want_prop_df.drop("len").sort("prop", descending = True)
     return have_want_prop_df
 
-def join_have_want_count_dfs(left, right, left_on, right_on):
-    return left.join(other = right, left_on = left_on, right_on = right_on, how = "full")
+def join_have_want_count_dfs(left, right, on):
+    return left.join(other = right, on = on, how = "full", coalesce = True)
 
-def clean_prop_df(tech_category, have_column, prop_df, groups = []):
-    return prop_df.filter(~pl.col("prop").is_null()).select([pl.col(col) for col in [have_column, "prop"] + groups]).rename({have_column: tech_category}).sort("prop", descending = True)
+def clean_prop_df(tech_category, prop_df, groups = []):
+    return prop_df.filter(~pl.col("prop").is_null()).select([pl.col(col) for col in [tech_category, "prop"] + groups]).sort("prop", descending = True)
 
-def create_prop_have_who_want_df(tech_category, have_column, want_column, have_want_df, groups = []):
-    # filter where have column is not null (exclude respondents who have not used the tech)
+def create_prop_have_who_want_df(tech_category, have_want_df, groups = []):
+    # filter where has is true (exclude respondents who have not used the tech)
     # only consider the universe of respondents who have used the tech
-    have_want_df_filtered = have_want_df.filter(~pl.col(have_column).is_null())
+    have_want_df_filtered = have_want_df.filter(pl.col("has"))
     # find the number of haves and the number of wants who have
-    have_count_df = create_have_want_count_df(tech_category, have_column, have_want_df_filtered, groups = groups)
-    want_count_df = create_have_want_count_df(tech_category, want_column, have_want_df_filtered, groups = groups)
+    have_count_df = create_have_want_count_df(tech_category, "has", have_want_df_filtered, groups = groups)
+    want_count_df = create_have_want_count_df(tech_category, "wants", have_want_df_filtered, groups = groups)
     # then find the proportion --> number of wants who have / number of haves 
-    prop_df = join_have_want_count_dfs(left = have_count_df, right = want_count_df, left_on = [have_column] + groups, right_on = [want_column] + groups). \
+    prop_df = join_have_want_count_dfs(left = have_count_df, right = want_count_df, on = [tech_category] + groups). \
         with_columns((pl.col("len_right") / pl.col("len")).alias("prop"))
-    return clean_prop_df(tech_category, have_column, prop_df, groups = groups)
+    return clean_prop_df(tech_category, prop_df, groups = groups)
 
-def create_prop_want_who_not_have_df(tech_category, have_column, want_column, have_want_df, groups = []):
-    # filter where want column is not null (exclude respondents who do not want to use the tech)
+def create_prop_want_who_not_have_df(tech_category, have_want_df, groups = []):
+    # filter where wants is true (exclude respondents who do not want to use the tech)
     # only consider the universe of respondents who want to use the tech
-    have_want_df_filtered = have_want_df.filter(~pl.col(want_column).is_null())
+    have_want_df_filtered = have_want_df.filter(pl.col("wants"))
     # find the number of wants and the number of wants who have
-    have_count_df = create_have_want_count_df(tech_category, have_column, have_want_df_filtered, groups = groups)
-    want_count_df = create_have_want_count_df(tech_category, want_column, have_want_df_filtered, groups = groups)
+    have_count_df = create_have_want_count_df(tech_category, "has", have_want_df_filtered, groups = groups)
+    want_count_df = create_have_want_count_df(tech_category, "wants", have_want_df_filtered, groups = groups)
     # then find the proportion --> 1 - number of wants who have / number of wants = number of wants who do not have / number of wants
-    prop_df = join_have_want_count_dfs(left = want_count_df, right = have_count_df, left_on = [want_column] + groups, right_on = [have_column] + groups). \
+    prop_df = join_have_want_count_dfs(left = want_count_df, right = have_count_df, on = [tech_category] + groups). \
         with_columns((1 - pl.col("len_right") / pl.col("len")).alias("prop"))
-    return clean_prop_df(tech_category, have_column, prop_df, groups = groups)
+    return clean_prop_df(tech_category, prop_df, groups = groups)
 
-def create_plot_data(tech_category, metric, groups = [], exclusion_prop = None):
-    have_column, want_column = find_have_want_columns(tech_category)
-    have_want_df = create_have_want_df(df, have_column, want_column, groups = groups)
+# cache plot data for repeated tech category, metric, groups, and exclusion proportion selections
+# groups must be a tuple (hashable) and is converted to a list for polars
+@lru_cache(maxsize = 64)
+def create_plot_data(tech_category, metric, groups = (), exclusion_prop = None):
+    groups = list(groups)
+    # select the relevant columns from the precomputed have and want dataframe
+    # build the rest of the plot data as a single lazy query
+    have_want_df = have_want_dfs[tech_category].lazy().select(["ResponseId", tech_category, "has", "wants"] + groups)
+    n_respondents = have_want_n_respondents[tech_category]
     if "Number" in metric:
         y = "len"
-        column = have_column if "Have" in metric else want_column
-        exclusion_df = create_have_want_prop_df(tech_category, column, have_want_df, exclusion_prop = exclusion_prop, clean = True)
-        plot_data = create_have_want_count_df(tech_category, column, have_want_df, groups = groups, clean = True)
+        indicator = "has" if "Have" in metric else "wants"
+        exclusion_df = create_have_want_prop_df(tech_category, indicator, have_want_df, n_respondents, exclusion_prop = exclusion_prop, clean = True)
+        plot_data = create_have_want_count_df(tech_category, indicator, have_want_df, groups = groups, clean = True)
     else:
         y = "prop"
         if "Have Who Want" in metric:
-            column = have_column
-            plot_data = create_prop_have_who_want_df(tech_category, have_column, want_column, have_want_df, groups = groups)
+            indicator = "has"
+            plot_data = create_prop_have_who_want_df(tech_category, have_want_df, groups = groups)
         elif "Want Who Do Not Have" in metric:
-            column = want_column
-            plot_data = create_prop_want_who_not_have_df(tech_category, have_column, want_column, have_want_df, groups = groups)
+            indicator = "wants"
+            plot_data = create_prop_want_who_not_have_df(tech_category, have_want_df, groups = groups)
         elif "Have" in metric:
-            column = have_column
-            plot_data = create_have_want_prop_df(tech_category, have_column, have_want_df, groups = groups, clean = True)
+            indicator = "has"
+            plot_data = create_have_want_prop_df(tech_category, indicator, have_want_df, n_respondents, groups = groups, clean = True)
         elif "Want" in metric:
-            column = want_column
-            plot_data = create_have_want_prop_df(tech_category, want_column, have_want_df, groups = groups, clean = True)
-        exclusion_df = create_have_want_prop_df(tech_category, column, have_want_df, exclusion_prop = exclusion_prop, clean = True)
-    plot_data = plot_data.filter(pl.col(tech_category).is_in(list(exclusion_df[tech_category])))
+            indicator = "wants"
+            plot_data = create_have_want_prop_df(tech_category, indicator, have_want_df, n_respondents, groups = groups, clean = True)
+        exclusion_df = create_have_want_prop_df(tech_category, indicator, have_want_df, n_respondents, exclusion_prop = exclusion_prop, clean = True)
+    # only keep techs that meet the exclusion proportion (keep the sorted order of the plot data)
+    plot_data = plot_data.join(exclusion_df.select(tech_category), on = tech_category, how = "semi", maintain_order = "left")
+    # collect the lazy query (pivot is only available on eager dataframes)
+    plot_data = plot_data.collect(engine = "streaming")
     if len(groups) > 0:
         return plot_data.pivot(on = tech_category, values = y)
     return plot_data, y
         
 def create_plot_col(id, plot, include_metric_select = True):
-    card_body = [dcc.Graph(id = f"{id}_{plot}")]
+    # use pattern matching ids (type and side) so each callback is registered once for both sides
+    card_body = [dcc.Graph(id = {"type": plot, "side": id})]
     if include_metric_select:
-        card_body.insert(0, dmc.Group([dmc.Select(label = html.B("Analysis Metric"), data = metrics, w = 300, required = True, id = f"{id}_metric")]))
+        card_body.insert(0, dmc.Group([dmc.Select(label = html.B("Analysis Metric"), data = metrics, w = 300, required = True, id = {"type": "metric", "side": id})]))
         card_body.insert(1, html.Br())
     return dbc.Col([
         html.Div([
@@ -175,13 +202,17 @@ def create_plot_col(id, plot, include_metric_select = True):
             dbc.Card([
                 dbc.CardBody(card_body)
             ])
-        ], style = {"display": "none"}, id = f"{id}_{plot}_card")
+        ], style = {"display": "none"}, id = {"type": f"{plot}_card", "side": id})
     ], width = 6)
 
-df = clean_data(groups_info)
+df = load_data(groups_info).lazy()
 tech_categories = find_tech_categories(df)
 metrics = ["Number Have Worked With", "Proportion Have Worked With", "Number Want To Work With", "Proportion Want To Work With", "Proportion Have Who Want", "Proportion Want Who Do Not Have"]
 groups = sorted(["MainBranch", "PurchaseInfluence", "EdLevel", "YearsCodeBuckets", "YearsCodeProBuckets", "Age"])
+# precompute the have and want dataframe (including all group columns) for each tech category
+have_want_dfs = dict(zip(tech_categories, pl.collect_all([create_have_want_df(df, tech_category, groups = groups) for tech_category in tech_categories])))
+# find the number of respondents (to the relevant have and want questions) for each tech category
+have_want_n_respondents = {tech_category: have_want_df["ResponseId"].n_unique() for tech_category, have_want_df in have_want_dfs.items()}
 
 # create dash app
 app = Dash(external_stylesheets = [dbc.themes.CYBORG])
@@ -224,48 +255,46 @@ app.layout = html.Div([
 
 # create callbacks to update plots
 @app.callback(
-    Output(f"left_bar_plot_card", "style", allow_duplicate = True),
-    Output(f"right_bar_plot_card", "style", allow_duplicate = True),
+    Output({"type": "bar_plot_card", "side": ALL}, "style"),
     Input("tech_category", "value"),
     prevent_initial_call = True
 )
 def update_bar_plot_cards_style(tech_category):
     if tech_category is not None:
-        return {"display": "block"}, {"display": "block"}
-    return {"display": "none"}, {"display": "none"} 
+        return [{"display": "block"}, {"display": "block"}]
+    return [{"display": "none"}, {"display": "none"}]
 
-for id in ["left", "right"]:
-    @app.callback(
-        Output(f"{id}_bar_plot", "figure", allow_duplicate = True),
-        Input("tech_category", "value"),
-        Input("exclusion_prop", "value"),
-        Input(f"{id}_metric", "value"),
-        prevent_initial_call = True
-    )
-    def update_bar_plot(tech_category, exclusion_prop, metric):
-        exclusion_prop = None if exclusion_prop == "" else exclusion_prop
-        if tech_category is not None and metric is not None:
-            plot_data, y = create_plot_data(tech_category, metric, exclusion_prop = exclusion_prop)
-            return px.bar(plot_data, x = tech_category, y = y, title = f"{tech_category} - {metric}")
-        return px.bar()
+@app.callback(
+    Output({"type": "bar_plot", "side": MATCH}, "figure"),
+    Input("tech_category", "value"),
+    Input("exclusion_prop", "value"),
+    Input({"type": "metric", "side": MATCH}, "value"),
+    prevent_initial_call = True
+)
+def update_bar_plot(tech_category, exclusion_prop, metric):
+    exclusion_prop = None if exclusion_prop == "" else exclusion_prop
+    if tech_category is not None and metric is not None:
+        plot_data, y = create_plot_data(tech_category, metric, exclusion_prop = exclusion_prop)
+        return px.bar(plot_data, x = tech_category, y = y, title = f"{tech_category} - {metric}")
+    return px.bar()
 
-    @app.callback(
-        Output(f"{id}_heat_map", "figure"),
-        Output(f"{id}_heat_map_card", "style"),
-        Input("tech_category", "value"),
-        Input("exclusion_prop", "value"),
-        Input(f"{id}_metric", "value"),
-        Input("group", "value"),
-        prevent_initial_call = True
-    )
-    def update_heat_map(tech_category, exclusion_prop, metric, group):
-        exclusion_prop = None if exclusion_prop == "" else exclusion_prop
-        if tech_category is not None and metric is not None and group is not None:
-            groups = [group]
-            plot_data = create_plot_data(tech_category, metric, groups = groups, exclusion_prop = exclusion_prop)
-            text = ".2f" if "Prop" in metric else ".2s"
-            return px.imshow(plot_data.drop(groups), y = plot_data[group], x = plot_data.drop(groups).columns, text_auto = text, title = f"{tech_category} - {metric} by {group}"), {"display": "block"}
-        return {}, {"display": "none"}
+@app.callback(
+    Output({"type": "heat_map", "side": MATCH}, "figure"),
+    Output({"type": "heat_map_card", "side": MATCH}, "style"),
+    Input("tech_category", "value"),
+    Input("exclusion_prop", "value"),
+    Input({"type": "metric", "side": MATCH}, "value"),
+    Input("group", "value"),
+    prevent_initial_call = True
+)
+def update_heat_map(tech_category, exclusion_prop, metric, group):
+    exclusion_prop = None if exclusion_prop == "" else exclusion_prop
+    if tech_category is not None and metric is not None and group is not None:
+        groups = [group]
+        plot_data = create_plot_data(tech_category, metric, groups = tuple(groups), exclusion_prop = exclusion_prop)
+        text = ".2f" if "Prop" in metric else ".2s"
+        return px.imshow(plot_data.drop(groups), y = plot_data[group], x = plot_data.drop(groups).columns, text_auto = text, title = f"{tech_category} - {metric} by {group}"), {"display": "block"}
+    return {}, {"display": "none"}
 
 # run dash app
 if __name__ == "__main__":